@@ -14,53 +14,48 @@
 
 from __future__ import annotations
 
-import json
-import os
+import asyncio
 import re
 import uuid
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, List, Tuple
+from collections import defaultdict
+from typing import Optional, Dict, List, Set, Tuple
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
+from utils import guilds, ratelimit, sessions_db
+from utils.permissions import DENY_OW, PARTICIPANT_OW, READONLY_OW, member_ow
+
 # =========================
 # 定数
 # =========================
-DATA_DIR = "data"
-SESSIONS_PATH = os.path.join(DATA_DIR, "sessions.json")
 JST = timezone(timedelta(hours=9))
 MAX_PC = 12
+PANEL_REFRESH_DELAY = 0.3  # この間のパネル更新要求は1回の編集にまとめる（秒）
+CHANNEL_EDIT_CONCURRENCY = 5  # 複数chを一括で編集する時の同時実行数
 
 
 # =========================
-# DB Utility
+# Utility
 # =========================
-def ensure_data_dir():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(SESSIONS_PATH):
-        with open(SESSIONS_PATH, "w", encoding="utf-8") as f:
-            json.dump({"sessions": {}}, f, ensure_ascii=False, indent=2)
-
-
-def load_db() -> dict:
-    ensure_data_dir()
-    with open(SESSIONS_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+def jst_date() -> str:
+    return datetime.now(JST).strftime("%Y-%m-%d")
 
 
-def save_db(db: dict):
-    ensure_data_dir()
-    with open(SESSIONS_PATH, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+async def gather_limited(coros, limit: int = CHANNEL_EDIT_CONCURRENCY) -> list:
+    """
+    coros を最大 limit 個ずつ並行に実行する（例外は結果として返す）。
+    429 は discord.py 側が retry_after を待って再送するので、ここでは同時数だけ絞る。
+    """
+    sem = asyncio.Semaphore(limit)
 
+    async def _one(coro):
+        async with sem:
+            return await coro
 
-# =========================
-# Utility
-# =========================
-def jst_date() -> str:
-    return datetime.now(JST).strftime("%Y-%m-%d")
+    return await asyncio.gather(*(_one(c) for c in coros), return_exceptions=True)
 
 
 def make_pc_hos(n: int) -> List[str]:
@@ -69,10 +64,20 @@ def make_pc_hos(n: int) -> List[str]:
     return [f"PC{i}" for i in range(1, n + 1)]
 
 
+_WS_RE = re.compile(r"\s+")
+_BAD_RE = re.compile(r"[^\wぁ-んァ-ン一-龥ー\-]")
+_DASHES_RE = re.compile(r"-{2,}")
+_PC_RE = re.compile(r"pc(\d{1,2})", re.IGNORECASE)
+
+
 def safe_channel_name(text: str) -> str:
-    s = re.sub(r"\s+", "-", (text or "").strip())
-    s = re.sub(r"[^\wぁ-んァ-ン一-龥ー\-]", "", s)
-    s = re.sub(r"-{2,}", "-", s).strip("-")
+    s = (text or "").strip()
+    # 英数字/"_" と単独の "-" だけなら正規表現を通しても変わらない
+    if s.isascii() and s.replace("-", "").replace("_", "").isalnum() and "--" not in s and s[0] != "-" and s[-1] != "-":
+        return s.lower()[:90]
+    s = _WS_RE.sub("-", s)
+    s = _BAD_RE.sub("", s)
+    s = _DASHES_RE.sub("-", s).strip("-")
     return (s.lower()[:90] or "channel")
 
 
@@ -99,7 +104,7 @@ def is_admin(m: discord.Member) -> bool:
 
 
 def parse_pc_count(pc_text: str) -> Optional[int]:
-    m = re.fullmatch(r"pc(\d{1,2})", (pc_text or "").strip(), re.IGNORECASE)
+    m = _PC_RE.fullmatch((pc_text or "").strip())
     if not m:
         return None
     n = int(m.group(1))
@@ -114,36 +119,63 @@ def parse_pc_count(pc_text: str) -> Optional[int]:
 class HOSelectCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        ensure_data_dir()
+
+        # sid -> (表示に使う状態, Embed)。状態が変わらない限り Embed を作り直さない
+        self._embed_cache: Dict[str, Tuple[tuple, discord.Embed]] = {}
+        # sid -> パネルメッセージ（送信時に保持。無ければ PartialMessage で GET なしに編集）
+        self._panel_msgs: Dict[str, discord.Message | discord.PartialMessage] = {}
+        # sid -> 保留中のパネル更新（最後に要求された guild/session で1回だけ編集）
+        self._panel_pending: Dict[str, Tuple[discord.Guild, Optional[dict]]] = {}
+        self._panel_tasks: Set[asyncio.Task] = set()
+        # sid -> 見学者IDの set（JSON上は list のまま。在籍判定だけ O(1) に）
+        self._spectator_sets: Dict[str, Set[str]] = {}
+        # sid -> ロック（同時クリックでの HO 取り合い/個別ch二重作成を防ぐ）
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def cog_load(self):
+        # メモリ上の DB（session_channels と共有）。初回の読み込みはワーカースレッドで
+        self._db = await sessions_db.aload_db()
 
         # 永続View復元（パネルがあるセッションのみ）
-        db = load_db()
-        for sid, s in db.get("sessions", {}).items():
+        # ※ DB は session_channels と共有なので、参加パネルのセッション（ho_options を持たない）は除外
+        for sid, s in self._db["sessions"].items():
+            if not s.get("ho_options"):
+                continue
             if s.get("panel_message_id"):
-                bot.add_view(HOSelectView(self, sid))
+                self.bot.add_view(HOSelectView(self, sid, s))
+
+    async def cog_unload(self):
+        # 終了/リロード時に未保存の変更を落とさない
+        await sessions_db.flush()
 
     # ---------- session helpers ----------
     def new_session_id(self) -> str:
         return uuid.uuid4().hex[:8]
 
     def get_session(self, sid: str) -> Optional[dict]:
-        db = load_db()
-        return db.get("sessions", {}).get(sid)
+        return self._db["sessions"].get(sid)
+
+    def session_lock(self, sid: str) -> asyncio.Lock:
+        return self._locks[sid]
+
+    def spectator_set(self, session: dict) -> Set[str]:
+        ss = self._spectator_sets.get(session["id"])
+        if ss is None:
+            ss = self._spectator_sets[session["id"]] = set(session.setdefault("spectators", []))
+        return ss
 
-    def save_session(self, session: dict):
-        db = load_db()
-        db.setdefault("sessions", {})[session["id"]] = session
-        save_db(db)
+    async def save_session(self, session: dict):
+        await sessions_db.save_session(session)
 
-    def delete_session_from_db(self, sid: str):
-        db = load_db()
-        if sid in db.get("sessions", {}):
-            del db["sessions"][sid]
-            save_db(db)
+    async def delete_session_from_db(self, sid: str):
+        self._embed_cache.pop(sid, None)
+        self._spectator_sets.pop(sid, None)
+        self._locks.pop(sid, None)
+        self._panel_msgs.pop(sid, None)
+        await sessions_db.delete_session(sid)
 
     def find_session_by_name(self, name: str, requester: discord.Member) -> Optional[dict]:
-        db = load_db()
-        sessions = list(db.get("sessions", {}).values())
+        sessions = list(self._db["sessions"].values())
 
         # GM本人優先
         for s in sessions:
@@ -161,6 +193,21 @@ class HOSelectCog(commands.Cog):
     # ---------- embed/panel ----------
     def build_embed(self, session: dict) -> discord.Embed:
         archived = bool(session.get("archived", False))
+        hos = session.get("ho_options") or []
+        taken = session.get("ho_taken") or {}
+        state = (
+            session.get("name"),
+            session.get("gm_id"),
+            session.get("pc_count"),
+            archived,
+            len(session.get("spectators") or []),
+            tuple(hos),
+            tuple(ho in taken for ho in hos),
+        )
+        cached = self._embed_cache.get(session.get("id"))
+        if cached and cached[0] == state:
+            return cached[1]
+
         e = discord.Embed(
             title=f"🧩 HO選択：{session.get('name','session')}",
             description=f"Session ID: `{session.get('id')}`\nGM: <@{session.get('gm_id')}>",
@@ -170,34 +217,57 @@ class HOSelectCog(commands.Cog):
         e.add_field(name="状態", value=("🗄️ アーカイブ" if archived else "🟢 進行中"), inline=True)
         e.add_field(name="見学者", value=f"{len(session.get('spectators') or [])}人", inline=True)
 
-        taken = session.get("ho_taken") or {}
-        lines = []
-        for ho in (session.get("ho_options") or []):
-            lines.append(f"{'✅' if ho in taken else '⬜'} {ho}")
+        lines = [f"{'✅' if ho in taken else '⬜'} {ho}" for ho in hos]
         e.add_field(name="PC一覧", value=("\n".join(lines) if lines else "（未設定）"), inline=False)
 
         e.set_footer(text="PCを選ぶと、ニックネーム変更＋個別ch作成。見学はボタンで追加。")
+        self._embed_cache[session.get("id")] = (state, e)
         return e
 
-    async def refresh_panel(self, sid: str, guild: discord.Guild):
-        s = self.get_session(sid)
+    def request_panel_refresh(self, sid: str, guild: discord.Guild, session: Optional[dict] = None):
+        """
+        パネル更新を予約する（連打/同時クリックでも PANEL_REFRESH_DELAY 内は1回の編集にまとめる）
+        """
+        first = sid not in self._panel_pending
+        self._panel_pending[sid] = (guild, session)
+        if first:
+            task = asyncio.create_task(self._run_panel_refresh(sid))
+            self._panel_tasks.add(task)
+            task.add_done_callback(self._panel_tasks.discard)
+
+    async def _run_panel_refresh(self, sid: str):
+        await asyncio.sleep(PANEL_REFRESH_DELAY)
+        guild, session = self._panel_pending.pop(sid)
+        try:
+            await self.refresh_panel(sid, guild, session)
+        except Exception:
+            pass
+
+    async def refresh_panel(self, sid: str, guild: discord.Guild, session: Optional[dict] = None):
+        # 呼び出し側が既に session を持っていればそれを使う（再読込しない）
+        s = session if session is not None else self.get_session(sid)
         if not s:
             return
         ch_id = s.get("panel_channel_id")
         msg_id = s.get("panel_message_id")
         if not ch_id or not msg_id:
             return
-        ch = guild.get_channel(int(ch_id))
-        if not isinstance(ch, discord.TextChannel):
-            return
+
+        msg = self._panel_msgs.get(sid)
+        if msg is None or msg.id != int(msg_id):
+            ch = guild.get_channel(int(ch_id))
+            if not isinstance(ch, discord.TextChannel):
+                return
+            msg = ch.get_partial_message(int(msg_id))
+            self._panel_msgs[sid] = msg
+
         try:
-            msg = await ch.fetch_message(int(msg_id))
+            await msg.edit(embed=self.build_embed(s), view=HOSelectView(self, sid, s))
         except discord.NotFound:
-            return
-        await msg.edit(embed=self.build_embed(s), view=HOSelectView(self, sid))
+            self._panel_msgs.pop(sid, None)
 
     # ---------- anchor / ordering ----------
-    def _get_anchor_vc_and_category(
+    async def _get_anchor_vc_and_category(
         self, guild: discord.Guild, session: dict
     ) -> Tuple[Optional[discord.VoiceChannel], Optional[discord.CategoryChannel]]:
         vc = None
@@ -219,7 +289,7 @@ class HOSelectCog(commands.Cog):
         if vc and not cat and vc.category:
             cat = vc.category
             session["anchor_category_id"] = cat.id
-            self.save_session(session)
+            await self.save_session(session)
 
         return vc, cat
 
@@ -257,12 +327,10 @@ class HOSelectCog(commands.Cog):
         if base is None:
             return None
         pc_count = int(session.get("pc_count") or 0)
-        specs = [int(x) for x in (session.get("spectators") or [])]
-        specs_sorted = sorted(set(specs))
-        try:
-            idx = specs_sorted.index(int(spectator_uid))
-        except ValueError:
-            idx = len(specs_sorted)
+        specs = {int(x) for x in (session.get("spectators") or [])}
+        uid = int(spectator_uid)
+        # ソート済み一覧での位置 = 自分より小さいIDの数（毎回 sorted + index しない）
+        idx = sum(1 for x in specs if x < uid) if uid in specs else len(specs)
         # 個別の後ろに見学を並べる
         return base + 1 + pc_count + idx
 
@@ -273,9 +341,10 @@ class HOSelectCog(commands.Cog):
             ch = guild.get_channel(int(cid))
             if isinstance(ch, discord.CategoryChannel):
                 return ch
+        await ratelimit.channel_bucket(guild.id).acquire()
         cat = await guild.create_category(title)
         session[key] = cat.id
-        self.save_session(session)
+        await self.save_session(session)
         return cat
 
     async def ensure_archive_category(self, guild: discord.Guild, session: dict) -> discord.CategoryChannel:
@@ -284,6 +353,14 @@ class HOSelectCog(commands.Cog):
         return await self.ensure_category(guild, session, key, title)
 
     # ---------- permissions builders ----------
+    def _base_overwrites(self, guild: discord.Guild, gm: discord.Member) -> dict:
+        """
+        共有/個別/見学で共通の土台（@everyone 非表示 + Bot + GM）。
+        複数chをまとめて作る時は1回だけ作って base= で渡す（各builderはコピーして使う）。
+        """
+        everyone, me = guild.default_role, guild.me
+        return {everyone: DENY_OW, me: PARTICIPANT_OW, gm: PARTICIPANT_OW}
+
     def _make_personal_overwrites(
         self,
         guild: discord.Guild,
@@ -292,19 +369,13 @@ class HOSelectCog(commands.Cog):
         session: dict,
         *,
         archived: bool,
+        base: Optional[dict] = None,
     ) -> dict:
-        everyone = guild.default_role
-        ow = {
-            everyone: discord.PermissionOverwrite(view_channel=False),
-            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            gm: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            player: discord.PermissionOverwrite(view_channel=True, send_messages=(not archived), read_message_history=True),
-        }
+        ow = dict(base or self._base_overwrites(guild, gm))
+        ow[player] = member_ow(archived)
         # 見学者は閲覧のみ
-        for uid_s in (session.get("spectators") or []):
-            m = guild.get_member(int(uid_s))
-            if m:
-                ow[m] = discord.PermissionOverwrite(view_channel=True, read_message_history=True, send_messages=False)
+        spectators = filter(None, (guild.get_member(int(uid_s)) for uid_s in (session.get("spectators") or [])))
+        ow.update(dict.fromkeys(spectators, READONLY_OW))
         return ow
 
     def _make_spectator_overwrites(
@@ -314,14 +385,11 @@ class HOSelectCog(commands.Cog):
         spectator: discord.Member,
         *,
         archived: bool,
+        base: Optional[dict] = None,
     ) -> dict:
-        everyone = guild.default_role
-        return {
-            everyone: discord.PermissionOverwrite(view_channel=False),
-            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            gm: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            spectator: discord.PermissionOverwrite(view_channel=True, send_messages=(not archived), read_message_history=True),
-        }
+        ow = dict(base or self._base_overwrites(guild, gm))
+        ow[spectator] = member_ow(archived)
+        return ow
 
     def _make_shared_overwrites(
         self,
@@ -331,20 +399,9 @@ class HOSelectCog(commands.Cog):
         *,
         archived: bool,
     ) -> dict:
-        everyone = guild.default_role
-        ow = {
-            everyone: discord.PermissionOverwrite(view_channel=False),
-            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            gm: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-        }
-        for uid in member_ids:
-            m = guild.get_member(int(uid))
-            if m:
-                ow[m] = discord.PermissionOverwrite(
-                    view_channel=True,
-                    read_message_history=True,
-                    send_messages=(not archived),
-                )
+        ow = self._base_overwrites(guild, gm)
+        members = filter(None, (guild.get_member(int(uid)) for uid in member_ids))
+        ow.update(dict.fromkeys(members, member_ow(archived)))
         return ow
 
     # ---------- shared channel ----------
@@ -356,6 +413,7 @@ class HOSelectCog(commands.Cog):
         *,
         post_panel: bool,
     ) -> discord.TextChannel:
+        await guilds.ensure_chunked(guild)
         gm = guild.get_member(int(session["gm_id"]))
         if not gm:
             raise RuntimeError("GMが見つかりません。")
@@ -371,7 +429,7 @@ class HOSelectCog(commands.Cog):
         # anchor再保存（安全）
         session["anchor_vc_id"] = voice_channel.id
         session["anchor_category_id"] = voice_channel.category_id or None
-        self.save_session(session)
+        await self.save_session(session)
 
         # ✅ VCと同じカテゴリに置く（カテゴリが無い場合のみ、従来通りカテゴリ作成）
         anchor_vc = voice_channel
@@ -402,15 +460,17 @@ class HOSelectCog(commands.Cog):
                     reason="update shared",
                 )
                 if post_panel:
-                    view = HOSelectView(self, session["id"])
+                    view = HOSelectView(self, session["id"], session)
                     self.bot.add_view(view)
                     msg = await ch.send(embed=self.build_embed(session), view=view)
                     session["panel_channel_id"] = ch.id
                     session["panel_message_id"] = msg.id
-                    self.save_session(session)
+                    self._panel_msgs[session["id"]] = msg
+                    await self.save_session(session)
                 return ch
 
         # 無ければ新規作成
+        await ratelimit.channel_bucket(guild.id).acquire()
         ch = await guild.create_text_channel(
             name=ch_name,
             category=use_cat,
@@ -420,15 +480,16 @@ class HOSelectCog(commands.Cog):
             reason="create shared",
         )
         session["shared_channel_id"] = ch.id
-        self.save_session(session)
+        await self.save_session(session)
 
         if post_panel:
-            view = HOSelectView(self, session["id"])
+            view = HOSelectView(self, session["id"], session)
             self.bot.add_view(view)
             msg = await ch.send(embed=self.build_embed(session), view=view)
             session["panel_channel_id"] = ch.id
             session["panel_message_id"] = msg.id
-            self.save_session(session)
+            self._panel_msgs[session["id"]] = msg
+            await self.save_session(session)
 
         return ch
 
@@ -442,6 +503,7 @@ class HOSelectCog(commands.Cog):
         if not isinstance(ch, discord.TextChannel):
             return
 
+        await guilds.ensure_chunked(guild)
         gm = guild.get_member(int(session["gm_id"]))
         if not gm:
             return
@@ -454,19 +516,16 @@ class HOSelectCog(commands.Cog):
 
         participants.add(uid_s)
         session["participants"] = sorted(participants)
-        self.save_session(session)
+        # 保存は呼び出し側（HOSelect.callback）で最後に1回
 
         # overwrite追加（個別に付与）
         ow = ch.overwrites
-        ow[member] = discord.PermissionOverwrite(
-            view_channel=True,
-            read_message_history=True,
-            send_messages=(not archived),
-        )
+        ow[member] = member_ow(archived)
         await ch.edit(overwrites=ow, reason="add participant to shared")
 
     # ---------- channels create/update ----------
     async def create_or_update_personal_ch(self, guild: discord.Guild, session: dict, member: discord.Member, ho: str) -> discord.TextChannel:
+        await guilds.ensure_chunked(guild)
         gm = guild.get_member(int(session["gm_id"]))
         if not gm:
             raise RuntimeError("GMが見つかりません。")
@@ -474,7 +533,7 @@ class HOSelectCog(commands.Cog):
         archived = bool(session.get("archived", False))
 
         # ✅ VCと同じカテゴリへ（無いなら従来カテゴリ作成）
-        anchor_vc, anchor_cat = self._get_anchor_vc_and_category(guild, session)
+        anchor_vc, anchor_cat = await self._get_anchor_vc_and_category(guild, session)
         cat = anchor_cat
         if cat is None:
             cat = await self.ensure_category(guild, session, "ho_category_id", f"🧩HO個別：{session.get('name','session')}")
@@ -495,12 +554,14 @@ class HOSelectCog(commands.Cog):
                 await ch.edit(name=name, overwrites=ow, category=cat, topic=topic, position=desired_pos, reason="update personal")
                 return ch
 
+        await ratelimit.channel_bucket(guild.id).acquire()
         ch = await cat.create_text_channel(name=name, overwrites=ow, topic=topic, position=desired_pos, reason="create personal")
         rec[uid] = ch.id
-        self.save_session(session)
+        # 保存は呼び出し側（HOSelect.callback）で最後に1回
         return ch
 
     async def create_or_update_spectator_ch(self, guild: discord.Guild, session: dict, member: discord.Member) -> discord.TextChannel:
+        await guilds.ensure_chunked(guild)
         gm = guild.get_member(int(session["gm_id"]))
         if not gm:
             raise RuntimeError("GMが見つかりません。")
@@ -508,7 +569,7 @@ class HOSelectCog(commands.Cog):
         archived = bool(session.get("archived", False))
 
         # ✅ VCと同じカテゴリへ（無いなら従来カテゴリ作成）
-        anchor_vc, anchor_cat = self._get_anchor_vc_and_category(guild, session)
+        anchor_vc, anchor_cat = await self._get_anchor_vc_and_category(guild, session)
         cat = anchor_cat
         if cat is None:
             cat = await self.ensure_category(guild, session, "spectator_category_id", f"👀見学：{session.get('name','session')}")
@@ -529,34 +590,36 @@ class HOSelectCog(commands.Cog):
                 await ch.edit(name=name, overwrites=ow, category=cat, topic=topic, position=desired_pos, reason="update spectator")
                 return ch
 
+        await ratelimit.channel_bucket(guild.id).acquire()
         ch = await cat.create_text_channel(name=name, overwrites=ow, topic=topic, position=desired_pos, reason="create spectator")
         rec[uid] = ch.id
-        self.save_session(session)
+        # 保存は呼び出し側（HOSelectView.spectate）で最後に1回
         return ch
 
     async def apply_spectator_to_all_personals(self, guild: discord.Guild, session: dict, spectator: discord.Member, enable: bool) -> Tuple[int, int]:
-        updated = 0
-        failed = 0
+        async def _one(ch: discord.TextChannel):
+            ow = ch.overwrites
+            if enable:
+                # 既に同じ権限なら API を叩かない
+                if ow.get(spectator) == READONLY_OW:
+                    return
+                ow[spectator] = READONLY_OW
+            else:
+                if spectator not in ow:
+                    return
+                del ow[spectator]
+            await ch.edit(overwrites=ow, reason="spectator perms sync")
+
         personal_map = session.get("ho_personal_channels") or {}
-        for cid in personal_map.values():
-            ch = guild.get_channel(int(cid))
-            if not isinstance(ch, discord.TextChannel):
-                continue
-            try:
-                ow = ch.overwrites
-                if enable:
-                    ow[spectator] = discord.PermissionOverwrite(view_channel=True, read_message_history=True, send_messages=False)
-                else:
-                    if spectator in ow:
-                        del ow[spectator]
-                await ch.edit(overwrites=ow, reason="spectator perms sync")
-                updated += 1
-            except Exception:
-                failed += 1
-        return updated, failed
+        chans = [ch for ch in (guild.get_channel(int(cid)) for cid in personal_map.values()) if isinstance(ch, discord.TextChannel)]
+        # 個別chごとの編集は独立なので並行に
+        results = await gather_limited(_one(ch) for ch in chans)
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        return len(results) - failed, failed
 
     # ---------- restore nickname ----------
     async def restore_all_nicks(self, guild: discord.Guild, session: dict) -> Tuple[int, int, List[str]]:
+        await guilds.ensure_chunked(guild)
         restored = 0
         failed = 0
         fail_lines: List[str] = []
@@ -583,13 +646,14 @@ class HOSelectCog(commands.Cog):
         """
         stats = {"moved": 0, "failed": 0}
 
+        await guilds.ensure_chunked(guild)
         gm = guild.get_member(int(session["gm_id"]))
         if not gm:
             raise RuntimeError("GMが見つかりません。")
 
         archive_cat = await self.ensure_archive_category(guild, session)
         session["archived"] = True
-        self.save_session(session)
+        await self.save_session(session)
 
         # 共有ch
         try:
@@ -604,37 +668,30 @@ class HOSelectCog(commands.Cog):
         except Exception:
             stats["failed"] += 1
 
-        # 個別ch
+        # 個別ch / 見学ch（1chずつ独立なので並行に移動）
+        base_ow = self._base_overwrites(guild, gm)
+
+        jobs = []
         personal_map = session.get("ho_personal_channels") or {}
         for uid_s, cid in personal_map.items():
             ch = guild.get_channel(int(cid))
-            if not isinstance(ch, discord.TextChannel):
+            player = guild.get_member(int(uid_s))
+            if not isinstance(ch, discord.TextChannel) or not player:
                 continue
-            try:
-                player = guild.get_member(int(uid_s))
-                if not player:
-                    continue
-                ow = self._make_personal_overwrites(guild, gm, player, session, archived=True)
-                await ch.edit(category=archive_cat, overwrites=ow, reason="archive personal")
-                stats["moved"] += 1
-            except Exception:
-                stats["failed"] += 1
+            ow = self._make_personal_overwrites(guild, gm, player, session, archived=True, base=base_ow)
+            jobs.append(ch.edit(category=archive_cat, overwrites=ow, reason="archive personal"))
 
-        # 見学ch
         spec_map = session.get("spectator_channels") or {}
         for uid_s, cid in spec_map.items():
             ch = guild.get_channel(int(cid))
-            if not isinstance(ch, discord.TextChannel):
+            sp = guild.get_member(int(uid_s))
+            if not isinstance(ch, discord.TextChannel) or not sp:
                 continue
-            try:
-                sp = guild.get_member(int(uid_s))
-                if not sp:
-                    continue
-                ow = self._make_spectator_overwrites(guild, gm, sp, archived=True)
-                await ch.edit(category=archive_cat, overwrites=ow, reason="archive spectator")
-                stats["moved"] += 1
-            except Exception:
-                stats["failed"] += 1
+            ow = self._make_spectator_overwrites(guild, gm, sp, archived=True, base=base_ow)
+            jobs.append(ch.edit(category=archive_cat, overwrites=ow, reason="archive spectator"))
+
+        for r in await gather_limited(jobs):
+            stats["failed" if isinstance(r, Exception) else "moved"] += 1
 
         # 元カテゴリは空なら削除（※VCと同じカテゴリを使っている場合、IDが入ってないので消さない）
         for key in ("shared_category_id", "ho_category_id", "spectator_category_id"):
@@ -648,7 +705,7 @@ class HOSelectCog(commands.Cog):
             except Exception:
                 stats["failed"] += 1
 
-        self.save_session(session)
+        await self.save_session(session)
         return stats
 
     # ---------- delete ----------
@@ -670,8 +727,7 @@ class HOSelectCog(commands.Cog):
                 ch = guild.get_channel(int(ch_id))
                 if isinstance(ch, discord.TextChannel):
                     try:
-                        msg = await ch.fetch_message(int(msg_id))
-                        await msg.delete()
+                        await ch.get_partial_message(int(msg_id)).delete()
                         stats["deleted_panel"] += 1
                     except discord.NotFound:
                         pass
@@ -729,7 +785,7 @@ class HOSelectCog(commands.Cog):
 
         # DB削除
         try:
-            self.delete_session_from_db(session["id"])
+            await self.delete_session_from_db(session["id"])
         except Exception:
             stats["failed"] += 1
 
@@ -756,8 +812,7 @@ class HOSelectCog(commands.Cog):
             await interaction.response.send_message("先にVCへ入ってから `/setup` を実行してください。", ephemeral=True)
             return
 
-        db = load_db()
-        sessions = db.setdefault("sessions", {})
+        sessions = self._db["sessions"]
         sid = self.new_session_id()
         while sid in sessions:
             sid = self.new_session_id()
@@ -797,8 +852,7 @@ class HOSelectCog(commands.Cog):
             "archived": False,
         }
 
-        sessions[sid] = session
-        save_db(db)
+        await self.save_session(session)
 
         # 共有ch作成 + パネル投稿（共有ch内）
         try:
@@ -861,10 +915,10 @@ class HOSelectCog(commands.Cog):
 # UI: セレクト
 # =========================
 class HOSelect(discord.ui.Select):
-    def __init__(self, cog: HOSelectCog, sid: str):
+    def __init__(self, cog: HOSelectCog, sid: str, session: Optional[dict] = None):
         self.cog = cog
         self.sid = sid
-        s = cog.get_session(sid) or {}
+        s = (session if session is not None else cog.get_session(sid)) or {}
 
         opts = [discord.SelectOption(label=h, value=h) for h in (s.get("ho_options") or [])]
 
@@ -889,59 +943,67 @@ class HOSelect(discord.ui.Select):
             return
 
         ho = self.values[0]
-        taken = s.setdefault("ho_taken", {})
-        if ho in taken and taken[ho] != str(interaction.user.id):
-            await interaction.response.send_message("そのPCは使用済みです。", ephemeral=True)
-            return
-
-        await interaction.response.defer(ephemeral=True, thinking=True)
-
         uid = str(interaction.user.id)
 
-        # 旧割当の解除
-        assignments = s.setdefault("ho_assignments", {})
-        old = assignments.get(uid)
-        if old and taken.get(old) == uid:
-            del taken[old]
-
-        assignments[uid] = ho
-        taken[ho] = uid
-
-        # 元nick保存（初回だけ）
-        originals = s.setdefault("original_nicks", {})
-        if uid not in originals:
-            originals[uid] = interaction.user.nick  # Noneなら解除状態
-
-        # nick変更
-        desired = build_ho_nick(interaction.user, ho)
-        nick_ok, nick_msg = await try_set_nickname(interaction.user, desired, reason="PC selected")
+        # ロック待ちで応答期限(3秒)を超えないよう、先に defer してから直列化する
+        await interaction.response.defer(ephemeral=True, thinking=True)
 
-        # 共有ch権限を自動更新（参加者に追加）
-        try:
-            await self.cog.ensure_shared_channel_has_member(interaction.guild, s, interaction.user)
-        except Exception:
-            pass
+        # 同時選択で同じPCを2人が取ったり、連打で個別chが二重に作られないよう、セッション単位で直列化
+        async with self.cog.session_lock(self.sid):
+            taken = s.setdefault("ho_taken", {})
+            if ho in taken and taken[ho] != uid:
+                await interaction.followup.send("そのPCは使用済みです。", ephemeral=True)
+                return
+
+            # 同じPCを選び直しただけ（nick/個別chも揃っている）なら何もしない（保存/権限更新/パネル更新なし）
+            if (s.get("ho_assignments") or {}).get(uid) == ho and taken.get(ho) == uid:
+                pcid = (s.get("ho_personal_channels") or {}).get(uid)
+                pch = interaction.guild.get_channel(int(pcid)) if pcid else None
+                if isinstance(pch, discord.TextChannel) and interaction.user.nick == build_ho_nick(interaction.user, ho):
+                    await interaction.followup.send(f"すでに {ho} を選択済みです。\n個別ch：{pch.mention}", ephemeral=True)
+                    return
+
+            # 旧割当の解除
+            assignments = s.setdefault("ho_assignments", {})
+            old = assignments.get(uid)
+            if old and taken.get(old) == uid:
+                del taken[old]
+
+            assignments[uid] = ho
+            taken[ho] = uid
+
+            # 元nick保存（初回だけ）
+            originals = s.setdefault("original_nicks", {})
+            if uid not in originals:
+                originals[uid] = interaction.user.nick  # Noneなら解除状態
+
+            # nick変更
+            desired = build_ho_nick(interaction.user, ho)
+            nick_ok, nick_msg = await try_set_nickname(interaction.user, desired, reason="PC selected")
+
+            # 共有ch権限を自動更新（参加者に追加）
+            try:
+                await self.cog.ensure_shared_channel_has_member(interaction.guild, s, interaction.user)
+            except Exception:
+                pass
 
-        # 個別ch作成/更新（固定順: 共有→個別→見学）
-        try:
-            ch = await self.cog.create_or_update_personal_ch(interaction.guild, s, interaction.user, ho)
-            self.cog.save_session(s)
-            await interaction.followup.send(
-                f"✅ {ho} を選択しました。\n{nick_msg if nick_ok else '⚠️ '+nick_msg}\n個別ch：{ch.mention}",
-                ephemeral=True,
-            )
-        except Exception as e:
-            self.cog.save_session(s)
-            await interaction.followup.send(
-                f"✅ {ho} を選択しました。\n{nick_msg if nick_ok else '⚠️ '+nick_msg}\n⚠️ 個別ch作成失敗: {e}",
-                ephemeral=True,
-            )
+            # 個別ch作成/更新（固定順: 共有→個別→見学）
+            try:
+                ch = await self.cog.create_or_update_personal_ch(interaction.guild, s, interaction.user, ho)
+                await self.cog.save_session(s)
+                await interaction.followup.send(
+                    f"✅ {ho} を選択しました。\n{nick_msg if nick_ok else '⚠️ '+nick_msg}\n個別ch：{ch.mention}",
+                    ephemeral=True,
+                )
+            except Exception as e:
+                await self.cog.save_session(s)
+                await interaction.followup.send(
+                    f"✅ {ho} を選択しました。\n{nick_msg if nick_ok else '⚠️ '+nick_msg}\n⚠️ 個別ch作成失敗: {e}",
+                    ephemeral=True,
+                )
 
-        # パネル更新
-        try:
-            await self.cog.refresh_panel(self.sid, interaction.guild)
-        except Exception:
-            pass
+        # パネル更新（まとめて反映）
+        self.cog.request_panel_refresh(self.sid, interaction.guild, s)
 
 
 # =========================
@@ -982,11 +1044,11 @@ class ConfirmView(discord.ui.View):
 # UI: View（見学/アーカイブ/削除）
 # =========================
 class HOSelectView(discord.ui.View):
-    def __init__(self, cog: HOSelectCog, sid: str):
+    def __init__(self, cog: HOSelectCog, sid: str, session: Optional[dict] = None):
         super().__init__(timeout=None)
         self.cog = cog
         self.sid = sid
-        self.add_item(HOSelect(cog, sid))
+        self.add_item(HOSelect(cog, sid, session))
 
     @discord.ui.button(
         label="👀 見学する / 解除",
@@ -1007,36 +1069,36 @@ class HOSelectView(discord.ui.View):
 
         await interaction.response.defer(ephemeral=True, thinking=True)
 
-        spectators = s.setdefault("spectators", [])
-        uid = str(interaction.user.id)
-        enable = uid not in spectators
+        async with self.cog.session_lock(self.sid):
+            spec_set = self.cog.spectator_set(s)
+            uid = str(interaction.user.id)
+            enable = uid not in spec_set
+
+            if enable:
+                spec_set.add(uid)
+                s["spectators"].append(uid)
+                try:
+                    sch = await self.cog.create_or_update_spectator_ch(interaction.guild, s, interaction.user)
+                    spec_msg = f"✅ 見学開始：{sch.mention}"
+                except Exception as e:
+                    spec_msg = f"⚠️ 見学ch作成失敗: {e}"
+            else:
+                spec_set.discard(uid)
+                s["spectators"].remove(uid)
+                spec_msg = "✅ 見学解除"
 
-        if enable:
-            spectators.append(uid)
+            # 個別chへの閲覧権限反映
             try:
-                sch = await self.cog.create_or_update_spectator_ch(interaction.guild, s, interaction.user)
-                spec_msg = f"✅ 見学開始：{sch.mention}"
+                updated, failed = await self.cog.apply_spectator_to_all_personals(interaction.guild, s, interaction.user, enable)
+                perm_msg = f"個別ch権限：更新 {updated} / 失敗 {failed}"
             except Exception as e:
-                spec_msg = f"⚠️ 見学ch作成失敗: {e}"
-        else:
-            spectators.remove(uid)
-            spec_msg = "✅ 見学解除"
+                perm_msg = f"⚠️ 個別ch権限反映失敗: {e}"
 
-        # 個別chへの閲覧権限反映
-        try:
-            updated, failed = await self.cog.apply_spectator_to_all_personals(interaction.guild, s, interaction.user, enable)
-            perm_msg = f"個別ch権限：更新 {updated} / 失敗 {failed}"
-        except Exception as e:
-            perm_msg = f"⚠️ 個別ch権限反映失敗: {e}"
-
-        self.cog.save_session(s)
+            await self.cog.save_session(s)
 
         await interaction.followup.send(f"{spec_msg}\n{perm_msg}", ephemeral=True)
 
-        try:
-            await self.cog.refresh_panel(self.sid, interaction.guild)
-        except Exception:
-            pass
+        self.cog.request_panel_refresh(self.sid, interaction.guild, s)
 
     @discord.ui.button(
         label="🗄️ アーカイブ（閲覧のみ）",
@@ -1058,26 +1120,25 @@ class HOSelectView(discord.ui.View):
         async def _do(inter: discord.Interaction):
             await inter.response.defer(ephemeral=True, thinking=True)
 
-            restored, failed, fail_lines = await self.cog.restore_all_nicks(inter.guild, s)
-
-            try:
-                stats = await self.cog.archive_session(inter.guild, s)
-                msg = (
-                    f"🗄️ **アーカイブ完了**\n"
-                    f"ニック復元：{restored}（失敗 {failed}）\n"
-                    f"移動/更新：{stats['moved']} / 失敗：{stats['failed']}\n"
-                    f"※ 共有/個別/見学は “閲覧のみ” になりました"
-                )
-                if fail_lines:
-                    msg += "\n\n⚠️ ニック復元失敗（抜粋）:\n" + "\n".join(fail_lines[:10])
-                await inter.followup.send(msg, ephemeral=True)
-            except Exception as e:
-                await inter.followup.send(f"⚠️ アーカイブ失敗: {e}", ephemeral=True)
-
-            try:
-                await self.cog.refresh_panel(self.sid, inter.guild)
-            except Exception:
-                pass
+            # 確認ボタンの二度押しでアーカイブカテゴリが2つ作られないよう、セッション単位で直列化
+            async with self.cog.session_lock(self.sid):
+                restored, failed, fail_lines = await self.cog.restore_all_nicks(inter.guild, s)
+
+                try:
+                    stats = await self.cog.archive_session(inter.guild, s)
+                    msg = (
+                        f"🗄️ **アーカイブ完了**\n"
+                        f"ニック復元：{restored}（失敗 {failed}）\n"
+                        f"移動/更新：{stats['moved']} / 失敗：{stats['failed']}\n"
+                        f"※ 共有/個別/見学は “閲覧のみ” になりました"
+                    )
+                    if fail_lines:
+                        msg += "\n\n⚠️ ニック復元失敗（抜粋）:\n" + "\n".join(fail_lines[:10])
+                    await inter.followup.send(msg, ephemeral=True)
+                except Exception as e:
+                    await inter.followup.send(f"⚠️ アーカイブ失敗: {e}", ephemeral=True)
+
+            self.cog.request_panel_refresh(self.sid, inter.guild, s)
 
         v = ConfirmView(_do, confirm_label="アーカイブ実行", cancel_label="やめる")
         v.bind_labels()
@@ -1154,7 +1215,7 @@ async def setup(bot: commands.Bot):
 # （discord.py は View.__init__ 終了時点で custom_id を持っていればOK）
 # =========================
 _orig_view_init = HOSelectView.__init__
-def _patched_view_init(self, cog: HOSelectCog, sid: str):
-    _orig_view_init(self, cog, sid)
+def _patched_view_init(self, cog: HOSelectCog, sid: str, session: Optional[dict] = None):
+    _orig_view_init(self, cog, sid, session)
     self._fix_custom_ids()
 HOSelectView.__init__ = _patched_view_init
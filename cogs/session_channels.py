@@ -1,57 +1,55 @@
 # cogs/session_channels.py
-import json
-import os
+import asyncio
+import functools
 import re
 import time
-from typing import List, Optional, Tuple
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
+from utils import guilds, ratelimit, sessions_db
+from utils.permissions import DENY_OW, PARTICIPANT_OW
 
-DATA_DIR = "data"
-SESSIONS_PATH = os.path.join(DATA_DIR, "sessions.json")
 
-
-def ensure_data_dir():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(SESSIONS_PATH):
-        with open(SESSIONS_PATH, "w", encoding="utf-8") as f:
-            json.dump({"sessions": {}}, f, ensure_ascii=False, indent=2)
-
-
-def load_db() -> dict:
-    ensure_data_dir()
-    with open(SESSIONS_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-def save_db(db: dict):
-    ensure_data_dir()
-    with open(SESSIONS_PATH, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+OVERWRITE_UPDATE_DELAY = 1.0  # 参加/辞退の連打をまとめて1回の権限更新にする待ち時間（秒）
 
 
 def make_session_id(guild_id: int) -> str:
-    ts = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+    ts = time.strftime("%Y%m%d-%H%M%S")  # 既定でローカル時刻
     return f"{ts}-{guild_id}"
 
 
+_WS_RE = re.compile(r"\s+")
+_BAD_RE = re.compile(r"[^0-9A-Za-zぁ-んァ-ン一-龥ー\-]")
+_DASHES_RE = re.compile(r"-{2,}")
+
+
+@functools.lru_cache(maxsize=1024)
 def safe_channel_name(name: str) -> str:
     name = name.strip()
-    name = re.sub(r"\s+", "-", name)
-    name = re.sub(r"[^0-9A-Za-zぁ-んァ-ン一-龥ー\-]", "", name)
-    name = re.sub(r"-{2,}", "-", name).strip("-")
+    # 英数字と単独の "-" だけなら正規表現を通しても変わらない
+    if name.isascii() and name.replace("-", "").isalnum() and "--" not in name and name[0] != "-" and name[-1] != "-":
+        return name[:90].lower()
+    name = _WS_RE.sub("-", name)
+    name = _BAD_RE.sub("", name)
+    name = _DASHES_RE.sub("-", name).strip("-")
     if not name:
         name = "session"
     return name[:90].lower()
 
 
+def _overwrite_key(overwrites: dict) -> Dict[int, tuple]:
+    # 対象ID -> (allow, deny) の値。PermissionOverwrite 同士を比べるための形
+    return {t.id: tuple(p.value for p in ow.pair()) for t, ow in overwrites.items()}
+
+
 def mention_list(user_ids: List[int]) -> str:
     if not user_ids:
         return "（まだいません）"
-    return "\n".join(f"- <@{uid}>" for uid in user_ids)
+    return "- <@" + ">\n- <@".join(map(str, user_ids)) + ">"
 
 
 class SessionPanelView(discord.ui.View):
@@ -61,11 +59,12 @@ class SessionPanelView(discord.ui.View):
         self.session_id = session_id
 
     async def _refresh_panel(self, interaction: discord.Interaction):
-        await self.cog.refresh_panel(self.session_id, interaction=interaction)
+        # ボタンが押されたメッセージ = パネル本体なので、そのまま編集に使う（再取得しない）
+        await self.cog.refresh_panel(self.session_id, interaction=interaction, message=interaction.message)
 
     @discord.ui.button(label="参加", style=discord.ButtonStyle.success, custom_id="session_join")
     async def join(self, interaction: discord.Interaction, button: discord.ui.Button):
-        ok, msg = self.cog.add_player(self.session_id, interaction.user.id)
+        ok, msg = await self.cog.add_player(self.session_id, interaction.user.id)
         await interaction.response.send_message(msg, ephemeral=True)
 
         if ok:
@@ -79,17 +78,14 @@ class SessionPanelView(discord.ui.View):
 
     @discord.ui.button(label="辞退", style=discord.ButtonStyle.secondary, custom_id="session_leave")
     async def leave(self, interaction: discord.Interaction, button: discord.ui.Button):
-        ok, msg = self.cog.remove_player(self.session_id, interaction.user.id)
+        ok, msg = await self.cog.remove_player(self.session_id, interaction.user.id)
         await interaction.response.send_message(msg, ephemeral=True)
 
         if ok:
             await self._refresh_panel(interaction)
 
             # ✅ 辞退時：既存チャンネルがあれば権限から外す（チャンネルは消さない）
-            try:
-                await self.cog.auto_update_participants_channel(self.session_id, interaction.guild)
-            except Exception:
-                pass
+            self.cog.request_participants_update(self.session_id, interaction.guild)
 
     @discord.ui.button(label="チャンネル作成/更新(GM)", style=discord.ButtonStyle.primary, custom_id="session_build")
     async def build(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -119,7 +115,7 @@ class SessionPanelView(discord.ui.View):
             await interaction.response.send_message("この操作はGMのみ実行できます。", ephemeral=True)
             return
         s["locked"] = not s.get("locked", False)
-        self.cog.save_session(s)
+        await self.cog.save_session(s)
         await interaction.response.send_message(
             f"参加を {'ロック' if s['locked'] else '解除'} しました。",
             ephemeral=True
@@ -130,53 +126,95 @@ class SessionPanelView(discord.ui.View):
 class SessionChannelsCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        ensure_data_dir()
-
-        # 永続View復元
-        db = load_db()
-        for sid in db.get("sessions", {}).keys():
-            self.bot.add_view(SessionPanelView(self, sid))
+        # sid -> 参加者IDの set（JSON上は順序付きの list のまま。在籍判定だけ O(1) に）
+        self._player_sets: Dict[str, Set[int]] = {}
+        # sid -> 参加者メンション一覧の文字列（players が変わった時だけ作り直す）
+        self._players_render: Dict[str, str] = {}
+        # sid -> パネルの View
+        self._views: Dict[str, SessionPanelView] = {}
+        # sid -> ロック（同時クリックで全体/GMチャンネルを二重に作らないように）
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # sid -> guild（参加者チャンネルの権限更新待ち）
+        self._overwrite_pending: Dict[str, discord.Guild] = {}
+        self._overwrite_tasks: Set[asyncio.Task] = set()
+
+    async def cog_load(self):
+        # メモリ上の DB（ho_select と共有）。初回の読み込みはワーカースレッドで
+        self._db = await sessions_db.aload_db()
+
+        # 永続View復元（このCogのパネルのみ / パネルメッセージに紐付け）
+        # ※ DB は ho_select と共有なので HO セッション（players を持たない）は除外
+        for sid, s in self._db["sessions"].items():
+            if "players" not in s:
+                continue
+            self.bot.add_view(self._view_for(sid), message_id=s.get("panel_message_id"))
+
+    async def cog_unload(self):
+        # 終了/リロード時に未保存の変更を落とさない
+        await sessions_db.flush()
+
+    def _view_for(self, session_id: str) -> SessionPanelView:
+        # パネルの View はセッションごとに1つだけ作って使い回す（編集のたびに Button を作り直さない）
+        view = self._views.get(session_id)
+        if view is None:
+            view = self._views[session_id] = SessionPanelView(self, session_id)
+        return view
 
     def get_session(self, session_id: str) -> Optional[dict]:
-        db = load_db()
-        return db.get("sessions", {}).get(session_id)
+        return self._db["sessions"].get(session_id)
+
+    async def save_session(self, session: dict):
+        await sessions_db.save_session(session)
 
-    def save_session(self, session: dict):
-        db = load_db()
-        db.setdefault("sessions", {})[session["id"]] = session
-        save_db(db)
+    def _player_set(self, s: dict) -> Set[int]:
+        ps = self._player_sets.get(s["id"])
+        if ps is None:
+            ps = self._player_sets[s["id"]] = set(s.setdefault("players", []))
+        return ps
 
-    def add_player(self, session_id: str, user_id: int) -> Tuple[bool, str]:
+    async def add_player(self, session_id: str, user_id: int) -> Tuple[bool, str]:
+        # 判定から追加までの間に await が無いのでロック不要（ビルド中でも待たせず即応答する）
         s = self.get_session(session_id)
         if not s:
             return False, "セッションが見つかりません。"
         if s.get("locked"):
             return False, "参加はロックされています（GMに連絡してください）。"
-        players = s.setdefault("players", [])
-        if user_id in players:
+        ps = self._player_set(s)
+        if user_id in ps:
             return False, "すでに参加しています。"
-        players.append(user_id)
-        self.save_session(s)
+        ps.add(user_id)
+        s["players"].append(user_id)
+        self._players_render[session_id] = mention_list(s["players"])
+        await self.save_session(s)
         return True, "参加しました！"
 
-    def remove_player(self, session_id: str, user_id: int) -> Tuple[bool, str]:
+    async def remove_player(self, session_id: str, user_id: int) -> Tuple[bool, str]:
         s = self.get_session(session_id)
         if not s:
             return False, "セッションが見つかりません。"
-        players = s.setdefault("players", [])
-        if user_id not in players:
+        ps = self._player_set(s)
+        if user_id not in ps:
             return False, "参加していません。"
-        players.remove(user_id)
-        self.save_session(s)
+        ps.discard(user_id)
+        s["players"].remove(user_id)
+        self._players_render[session_id] = mention_list(s["players"])
+        await self.save_session(s)
         return True, "辞退しました。"
 
+    def _players_text(self, s: dict) -> str:
+        text = self._players_render.get(s["id"])
+        if text is None:
+            text = self._players_render[s["id"]] = mention_list(s.get("players", []))
+        return text
+
     def build_embed(self, session: dict) -> discord.Embed:
+        players = session.get("players", [])
         e = discord.Embed(
             title=f"🎭 セッション参加パネル：{session['name']}",
             description=f"ID: `{session['id']}`\nGM: <@{session['gm_id']}>\n参加ロック: **{'ON' if session.get('locked') else 'OFF'}**",
             color=discord.Color.pink(),
         )
-        e.add_field(name=f"参加者（{len(session.get('players', []))}）", value=mention_list(session.get("players", [])), inline=False)
+        e.add_field(name=f"参加者（{len(players)}）", value=self._players_text(session), inline=False)
 
         if session.get("category_id"):
             e.add_field(name="カテゴリ", value=f"<#{session['category_id']}>", inline=False)
@@ -187,7 +225,12 @@ class SessionChannelsCog(commands.Cog):
 
         return e
 
-    async def refresh_panel(self, session_id: str, interaction: Optional[discord.Interaction] = None):
+    async def refresh_panel(
+        self,
+        session_id: str,
+        interaction: Optional[discord.Interaction] = None,
+        message: Optional[Union[discord.Message, discord.PartialMessage]] = None,
+    ):
         s = self.get_session(session_id)
         if not s:
             return
@@ -196,21 +239,25 @@ class SessionChannelsCog(commands.Cog):
         if not channel_id or not message_id:
             return
 
-        guild = interaction.guild if interaction else self.bot.get_guild(s["guild_id"])
-        if not guild:
-            return
-        ch = guild.get_channel(channel_id)
-        if not isinstance(ch, discord.TextChannel):
-            return
+        if message is not None and message.id == message_id:
+            msg = message
+        else:
+            guild = interaction.guild if interaction else self.bot.get_guild(s["guild_id"])
+            if not guild:
+                return
+            ch = guild.get_channel(channel_id)
+            if not isinstance(ch, discord.TextChannel):
+                return
 
+            # 編集だけなら GET は不要（ID から PartialMessage を作って PATCH のみ）
+            msg = ch.get_partial_message(message_id)
+
+        view = self._view_for(session_id)
         try:
-            msg = await ch.fetch_message(message_id)
-        except Exception:
+            await msg.edit(embed=self.build_embed(s), view=view)
+        except discord.NotFound:
             return
 
-        view = SessionPanelView(self, session_id)
-        await msg.edit(embed=self.build_embed(s), view=view)
-
     async def _apply_all_channel_overwrites(
         self,
         guild: discord.Guild,
@@ -220,17 +267,38 @@ class SessionChannelsCog(commands.Cog):
     ):
         everyone = guild.default_role
         overwrites = {
-            everyone: discord.PermissionOverwrite(view_channel=False),
-            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            gm_member: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
+            everyone: DENY_OW,
+            guild.me: PARTICIPANT_OW,
+            gm_member: PARTICIPANT_OW,
         }
-        for uid in player_ids:
-            m = guild.get_member(uid)
-            if m:
-                overwrites[m] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+        members = filter(None, map(guild.get_member, player_ids))
+        overwrites.update(dict.fromkeys(members, PARTICIPANT_OW))
+
+        # 変化が無ければ API を叩かない（連打での 429 を避ける）
+        if _overwrite_key(overwrites) == _overwrite_key(channel.overwrites):
+            return
 
         await channel.edit(overwrites=overwrites, reason="session participants updated")
 
+    def request_participants_update(self, session_id: str, guild: discord.Guild):
+        """
+        参加者チャンネルの権限更新を予約する（OVERWRITE_UPDATE_DELAY 内の参加/辞退は1回の編集にまとめる）
+        """
+        first = session_id not in self._overwrite_pending
+        self._overwrite_pending[session_id] = guild
+        if first:
+            task = asyncio.create_task(self._run_participants_update(session_id))
+            self._overwrite_tasks.add(task)
+            task.add_done_callback(self._overwrite_tasks.discard)
+
+    async def _run_participants_update(self, session_id: str):
+        await asyncio.sleep(OVERWRITE_UPDATE_DELAY)
+        guild = self._overwrite_pending.pop(session_id)
+        try:
+            await self.auto_update_participants_channel(session_id, guild)
+        except Exception:
+            pass
+
     async def auto_update_participants_channel(self, session_id: str, guild: discord.Guild):
         s = self.get_session(session_id)
         if not s:
@@ -241,6 +309,7 @@ class SessionChannelsCog(commands.Cog):
         ch = guild.get_channel(all_id)
         if not isinstance(ch, discord.TextChannel):
             return
+        await guilds.ensure_chunked(guild)
         gm_member = guild.get_member(s["gm_id"])
         if not gm_member:
             return
@@ -260,13 +329,18 @@ class SessionChannelsCog(commands.Cog):
         if s.get("channel_all_id"):
             ch = guild.get_channel(s["channel_all_id"])
             if isinstance(ch, discord.TextChannel):
-                await self.auto_update_participants_channel(session_id, guild)
+                self.request_participants_update(session_id, guild)
                 return
 
         # 無いなら作る（参加者が1人以上いる想定）
         await self.build_or_update_channels(session_id, guild)
 
     async def build_or_update_channels(self, session_id: str, guild: discord.Guild) -> str:
+        # 同時に参加が来ても全体/GMチャンネルを二重に作らない
+        async with self._locks[session_id]:
+            return await self._build_or_update_channels(session_id, guild)
+
+    async def _build_or_update_channels(self, session_id: str, guild: discord.Guild) -> str:
         s = self.get_session(session_id)
         if not s:
             return "セッションが見つかりません。"
@@ -275,10 +349,20 @@ class SessionChannelsCog(commands.Cog):
         if not players:
             return "参加者がいません。"
 
+        await guilds.ensure_chunked(guild)
         gm_member = guild.get_member(s["gm_id"])
         if gm_member is None:
             return "GMがこのサーバーに見つかりません。"
 
+        # メンバーは1回だけ引いて使い回す
+        player_members = [m for m in (guild.get_member(uid) for uid in players) if m]
+        # 全体/GM 共通の土台（@everyone 非表示 + Bot + GM）
+        base_ow = {
+            guild.default_role: DENY_OW,
+            guild.me: PARTICIPANT_OW,
+            gm_member: PARTICIPANT_OW,
+        }
+
         # カテゴリ
         category: Optional[discord.CategoryChannel] = None
         if s.get("category_id"):
@@ -286,6 +370,7 @@ class SessionChannelsCog(commands.Cog):
             if isinstance(cat, discord.CategoryChannel):
                 category = cat
         if category is None:
+            await ratelimit.channel_bucket(guild.id).acquire()
             category = await guild.create_category(name=f"🎭{s['name']}", reason="session auto build")
             s["category_id"] = category.id
 
@@ -298,57 +383,53 @@ class SessionChannelsCog(commands.Cog):
             if isinstance(ch, discord.TextChannel):
                 all_ch = ch
 
-        if all_ch is None:
-            everyone = guild.default_role
-            overwrites_all = {
-                everyone: discord.PermissionOverwrite(view_channel=False),
-                guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-                gm_member: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            }
-            for uid in players:
-                m = guild.get_member(uid)
-                if m:
-                    overwrites_all[m] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-
-            all_ch = await category.create_text_channel(
+        # GM専用（任意）
+        gm_ch: Optional[discord.TextChannel] = None
+        if s.get("channel_gm_id"):
+            ch = guild.get_channel(s["channel_gm_id"])
+            if isinstance(ch, discord.TextChannel):
+                gm_ch = ch
+
+        async def create_all_ch():
+            overwrites_all = {**base_ow, **dict.fromkeys(player_members, PARTICIPANT_OW)}
+
+            await ratelimit.channel_bucket(guild.id).acquire()
+            ch = await category.create_text_channel(
                 name=f"参加者-{base}",
                 overwrites=overwrites_all,
                 topic=f"Session {s['id']} / 参加者全体",
                 reason="session auto build",
             )
-            s["channel_all_id"] = all_ch.id
+            s["channel_all_id"] = ch.id
 
             # 初回案内
-            await all_ch.send(
+            await ch.send(
                 f"✅ セッション **{s['name']}** の参加者チャンネルを自動作成しました。\n"
                 f"GM: <@{s['gm_id']}>\n"
                 f"参加者は参加パネルから増やせます（増えたら権限も自動反映されます）。"
             )
-        else:
-            await self._apply_all_channel_overwrites(guild, all_ch, gm_member, players)
 
-        # GM専用（任意）
-        gm_ch: Optional[discord.TextChannel] = None
-        if s.get("channel_gm_id"):
-            ch = guild.get_channel(s["channel_gm_id"])
-            if isinstance(ch, discord.TextChannel):
-                gm_ch = ch
-        if gm_ch is None:
-            everyone = guild.default_role
-            overwrites_gm = {
-                everyone: discord.PermissionOverwrite(view_channel=False),
-                guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-                gm_member: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
-            }
-            gm_ch = await category.create_text_channel(
+        async def create_gm_ch():
+            await ratelimit.channel_bucket(guild.id).acquire()
+            ch = await category.create_text_channel(
                 name=f"gm-{base}",
-                overwrites=overwrites_gm,
+                overwrites=base_ow,
                 topic=f"Session {s['id']} / GM only",
                 reason="session auto build",
             )
-            s["channel_gm_id"] = gm_ch.id
+            s["channel_gm_id"] = ch.id
 
-        self.save_session(s)
+        # ✅ 全体/GM の作成（or 権限更新）は互いに独立なので並行で投げる
+        jobs = [create_all_ch() if all_ch is None else self._apply_all_channel_overwrites(guild, all_ch, gm_member, players)]
+        if gm_ch is None:
+            jobs.append(create_gm_ch())
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+
+        # 片方だけ成功した場合も、作れた分のIDは保存してから失敗を返す
+        await self.save_session(s)
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
         return "✅ 参加者全体チャンネル（＋GM専用）を作成/更新しました。"
 
     # ---- commands ----
@@ -373,17 +454,25 @@ class SessionChannelsCog(commands.Cog):
             "channel_all_id": None,
             "channel_gm_id": None,
         }
-        self.save_session(session)
 
         embed = self.build_embed(session)
-        view = SessionPanelView(self, session_id)
+        view = self._view_for(session_id)
+
+        # パネルが見えた直後の参加クリックでも見つかるよう、送信前にメモリ上の DB へ登録
+        # （書き込みはデバウンスされるので、パネルID確定後の更新と合わせて1回のコミットになる）
+        await self.save_session(session)
 
         self.bot.add_view(view)
-        await interaction.response.send_message(embed=embed, view=view)
+        try:
+            await interaction.response.send_message(embed=embed, view=view)
+        except Exception:
+            # パネルを出せなかったセッションは残さない
+            await sessions_db.delete_session(session_id)
+            raise
 
         msg = await interaction.original_response()
         session["panel_message_id"] = msg.id
-        self.save_session(session)
+        await self.save_session(session)
 
     @app_commands.command(name="session_info", description="セッション情報を表示します（ID指定）")
     @app_commands.describe(session_id="セッションID")
@@ -15,15 +15,30 @@
 
 import os
 import asyncio
+import functools
+import hashlib
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
 
 import discord
+import orjson
 from discord.ext import commands
 
+try:
+    import uvloop  # 任意（Windows では入らない）
+except ImportError:
+    uvloop = None
+
 # =========================
 # 設定
 # =========================
 
+@functools.lru_cache(maxsize=None)
 def env_bool(key: str, default: bool = False) -> bool:
     v = os.getenv(key)
     if v is None:
@@ -35,6 +50,31 @@ TOKEN = (os.getenv("DISCORD_TOKEN", "") or "").strip()
 
 COMMAND_PREFIX = "!"
 
+# 開発/単一サーバー運用ならギルド同期（即時反映）。未設定ならグローバル同期
+GUILD_ID = (os.getenv("DISCORD_GUILD_ID", "") or "").strip()
+# DISCORD_GUILD_ID があってもグローバル同期もしたい時（本番反映など）に 1
+FORCE_GLOBAL_SYNC = env_bool("FORCE_GLOBAL_SYNC", default=False)
+
+CLOSE_TIMEOUT = 5.0  # 終了時に bot.close() を待つ上限（秒）
+
+# コマンドエラー返信（キューに積んで1つのワーカーが送る / 同じチャンネル・同じ文面は間隔内なら1回だけ）
+ERROR_QUEUE_SIZE = 256
+ERROR_COALESCE = 5.0  # 秒
+
+# 前回同期したコマンド定義のハッシュ（変わっていなければ同期の REST を省く）
+CMD_TREE_HASH_PATH = os.path.join("data", "cmd_tree.hash")
+
+# uvloop があればイベントループを置き換える（プロファイラ使用時などは USE_UVLOOP=0 で標準ループ）
+USE_UVLOOP = env_bool("USE_UVLOOP", default=True)
+
+# ASYNCIO_DEBUG=1 で asyncio のデバッグモード（SLOW_CB 秒以上ループを止めた処理を警告ログに出す）
+ASYNCIO_DEBUG = env_bool("ASYNCIO_DEBUG", default=False)
+SLOW_CB = float(os.getenv("SLOW_CB", "0.1"))
+
+# REALTIME_LOOP=1 でイベントループのスレッドを SCHED_RR に（Linux + CAP_SYS_NICE が必要 / 無ければ何もしない）
+REALTIME_LOOP = env_bool("REALTIME_LOOP", default=False)
+REALTIME_PRIORITY = 10
+
 # ---- Intents ----
 # ✅ 特権インテントは「Developer PortalでONにしてないと落ちる」ので、
 #    環境変数で必要な時だけONにする。
@@ -49,11 +89,76 @@ ENABLE_MESSAGE_CONTENT = env_bool("ENABLE_MESSAGE_CONTENT", default=False)
 INTENTS = discord.Intents.default()
 INTENTS.guilds = True
 INTENTS.voice_states = True
+INTENTS.presences = False  # 使わない（READY/ギルド情報のペイロードを小さく）
 
 # 特権インテント（必要な時だけ）
 INTENTS.members = ENABLE_MEMBERS_INTENT
 INTENTS.message_content = ENABLE_MESSAGE_CONTENT
 
+# LOG_JSON=1 でログを1行1JSONに（ログ収集サービス向け / 時刻は record.created の数値のまま）
+LOG_JSON = env_bool("LOG_JSON", default=False)
+
+log = logging.getLogger("bot")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "t": record.created,
+            "lvl": record.levelname,
+            "name": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(data).decode()
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    同じプロセス内のキューなので pickle 用の整形は不要。
+    record をそのまま渡し、メッセージ/例外の整形は全部 listener スレッドで行う。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    ログはキューに積むだけにして、stdout への書き込みは別スレッドで行う（イベントループを止めない）。
+    戻り値の listener は終了時に stop() する。
+    """
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(q, handler)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(LocalQueueHandler(q))
+
+    listener.start()
+    return listener
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _write_text(path: str, text: str):
+    # 途中で落ちても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
 # =========================
 # Bot クラス
 # =========================
@@ -63,6 +168,10 @@ class Bot(commands.Bot):
             command_prefix=COMMAND_PREFIX,
             intents=INTENTS,
             help_command=None,
+            # 起動時に全ギルドのメンバーを取りに行かない（必要な時に utils.guilds.ensure_chunked で遅延取得）
+            chunk_guilds_at_startup=False,
+            # メッセージキャッシュは使っていない
+            max_messages=None,
         )
 
     async def setup_hook(self):
@@ -71,10 +180,14 @@ class Bot(commands.Bot):
         - Cogロード
         - スラッシュコマンド同期
         """
+        # ========= エラー返信ワーカー =========
+        self._err_q: asyncio.Queue = asyncio.Queue(maxsize=ERROR_QUEUE_SIZE)
+        self._err_worker = asyncio.create_task(self._drain_errors())
+
         # ========= Cog ロード =========
         EXTENSIONS = [
-            # VC共有テキスト作成（!setup など）
-            "cogs.session_channels",   # ✅ ここを修正
+            # セッション参加パネル → 参加者/GMチャンネル自動作成
+            "cogs.session_channels",
 
             # HO選択 → 個別ch自動作成
             "cogs.ho_select",
@@ -89,57 +202,162 @@ class Bot(commands.Bot):
             # "cogs.export_html",
         ]
 
-        for ext in EXTENSIONS:
-            try:
-                await self.load_extension(ext)
-                print(f"[LOAD] {ext}")
-            except Exception as e:
-                print(f"[ERROR] Failed to load {ext}: {type(e).__name__}: {e}")
+        # 互いに独立なので並行にロード（ログは EXTENSIONS の順で出す）
+        results = await asyncio.gather(*(self._safe_load(ext) for ext in EXTENSIONS))
+        for ext, error in zip(EXTENSIONS, results):
+            if error is None:
+                log.info("[LOAD] %s", ext)
+            else:
+                log.error("[ERROR] Failed to load %s: %s: %s", ext, type(error).__name__, error)
 
         # ========= Slash Command Sync =========
-        # グローバル同期（反映まで最大1時間）
+        # DISCORD_GUILD_ID があればそのギルドだけに一括同期（即時反映 / PUT 1回）。
+        # グローバル同期（反映まで最大1時間）は、ギルド未指定の時か FORCE_GLOBAL_SYNC=1 の時だけ
+        try:
+            targets: List[Optional[discord.Object]] = []
+            if GUILD_ID.isdigit():
+                guild = discord.Object(int(GUILD_ID))
+                self.tree.copy_global_to(guild=guild)
+                targets.append(guild)
+            if not targets or FORCE_GLOBAL_SYNC:
+                targets.append(None)
+
+            fingerprint = self._tree_fingerprint(targets)
+            if fingerprint == _read_text(CMD_TREE_HASH_PATH):
+                log.info("[SYNC] command tree unchanged, skip sync")
+            else:
+                for target in targets:
+                    synced = await self.tree.sync(guild=target)
+                    if target is None:
+                        log.info("[SYNC] %d commands synced globally", len(synced))
+                    else:
+                        log.info("[SYNC] %d commands synced to guild %s", len(synced), target.id)
+                _write_text(CMD_TREE_HASH_PATH, fingerprint)
+        except Exception as e:
+            log.error("[ERROR] Command sync failed: %s: %s", type(e).__name__, e)
+
+    def _tree_fingerprint(self, targets: List[Optional[discord.Object]]) -> str:
+        """同期先 + コマンド定義から作るハッシュ（定義/同期先/アプリが変われば変わる）"""
+        payload = {
+            "application_id": self.application_id,
+            "targets": [
+                {
+                    "guild": t.id if t is not None else None,
+                    "commands": [c.to_dict(self.tree) for c in self.tree.get_commands(guild=t)],
+                }
+                for t in targets
+            ],
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    async def _safe_load(self, ext: str) -> Optional[Exception]:
         try:
-            synced = await self.tree.sync()
-            print(f"[SYNC] {len(synced)} commands synced globally")
+            await self.load_extension(ext)
+            return None
         except Exception as e:
-            print(f"[ERROR] Command sync failed: {type(e).__name__}: {e}")
+            return e
 
     async def on_ready(self):
-        print("===================================")
-        print(f"Logged in as: {self.user}")
-        print(f"Bot ID: {self.user.id}")
-        print("Intents:")
-        print(f" - guilds={self.intents.guilds}")
-        print(f" - voice_states={self.intents.voice_states}")
-        print(f" - members={self.intents.members} (ENABLE_MEMBERS_INTENT={ENABLE_MEMBERS_INTENT})")
-        print(f" - message_content={self.intents.message_content} (ENABLE_MESSAGE_CONTENT={ENABLE_MESSAGE_CONTENT})")
-        print("===================================")
+        log.info("Logged in as: %s (Bot ID: %s)", self.user, self.user.id)
+        log.info(
+            "Intents: guilds=%s voice_states=%s members=%s (ENABLE_MEMBERS_INTENT=%s) message_content=%s (ENABLE_MESSAGE_CONTENT=%s)",
+            self.intents.guilds,
+            self.intents.voice_states,
+            self.intents.members,
+            ENABLE_MEMBERS_INTENT,
+            self.intents.message_content,
+            ENABLE_MESSAGE_CONTENT,
+        )
 
     async def on_command_error(self, ctx: commands.Context, error: Exception):
-        if isinstance(error, commands.CommandNotFound):
+        # 一番多い「存在しないコマンド」は型の一致だけで先に返す
+        if error.__class__ is commands.CommandNotFound or isinstance(error, commands.CommandNotFound):
             return
+        name = type(error).__name__
         try:
-            await ctx.reply(f"❌ エラーが発生しました: `{type(error).__name__}: {error}`")
-        except Exception:
-            pass
+            self._err_q.put_nowait((ctx, f"❌ エラーが発生しました: `{name}: {error}`"))
+        except asyncio.QueueFull:
+            log.warning("error reply dropped (queue full): %s: %s", name, error)
+
+    async def _drain_errors(self):
+        # (channel_id, 文面) -> 最後に返信した時刻
+        last_sent: Dict[Tuple[int, str], float] = {}
+        while True:
+            ctx, msg = await self._err_q.get()
+            key = (ctx.channel.id, msg)
+            now = time.monotonic()
+            if now - last_sent.get(key, -ERROR_COALESCE) < ERROR_COALESCE:
+                continue
+            last_sent[key] = now
+            try:
+                await ctx.reply(msg)
+            except Exception:
+                pass
+            # 古い記録は捨てる（dict が増え続けないように）
+            if len(last_sent) > ERROR_QUEUE_SIZE:
+                last_sent = {k: t for k, t in last_sent.items() if now - t < ERROR_COALESCE}
+
+    async def close(self):
+        worker = getattr(self, "_err_worker", None)
+        if worker is not None:
+            worker.cancel()
+        await super().close()
 
 
 # =========================
 # エントリーポイント
 # =========================
+def set_realtime_priority():
+    """
+    呼び出したスレッド（= イベントループ）だけを SCHED_RR にする。
+    SCHED_RESET_ON_FORK 付きなので、この後に作られるスレッド（to_thread のワーカー、DNS 解決など）は
+    SCHED_OTHER のまま（ループと同じ優先度で競合しない）。権限/OS非対応ならログだけ出して続行。
+    """
+    # SCHED_RESET_ON_FORK は Linux のみ（他の POSIX には sched_setscheduler だけある場合がある）
+    if not hasattr(os, "sched_setscheduler") or not hasattr(os, "SCHED_RESET_ON_FORK"):
+        log.warning("REALTIME_LOOP: sched_setscheduler is not available on this platform")
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_RR | os.SCHED_RESET_ON_FORK, os.sched_param(REALTIME_PRIORITY))
+        log.info("REALTIME_LOOP: event loop thread set to SCHED_RR (priority %d)", REALTIME_PRIORITY)
+    except PermissionError:
+        log.warning("REALTIME_LOOP: no permission (CAP_SYS_NICE required), keep default scheduler")
+
+
 async def main():
     if not TOKEN:
         raise RuntimeError("DISCORD_TOKEN が未設定/空です（環境変数 DISCORD_TOKEN を確認してください）")
 
     bot = Bot()
+    asyncio.get_running_loop().slow_callback_duration = SLOW_CB
+    if REALTIME_LOOP:
+        set_realtime_priority()
     try:
         await bot.start(TOKEN)
     finally:
         # ✅ 例外落ちでもコネクタ未クローズ警告を減らす
+        # ✅ 半分閉じた WebSocket 等で終わらないままにならないよう、待つのは CLOSE_TIMEOUT 秒まで
         if not bot.is_closed():
-            await bot.close()
+            try:
+                await asyncio.wait_for(bot.close(), timeout=CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning("bot.close() timed out after %.1fs", CLOSE_TIMEOUT)
+            except Exception as e:
+                log.warning("bot.close() failed: %s: %s", type(e).__name__, e)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    listener = setup_logging()
+    # 未指定（None）なら PYTHONASYNCIODEBUG / -X dev の設定に任せる
+    run_kwargs = {"debug": True if ASYNCIO_DEBUG else None}
+    if USE_UVLOOP and uvloop is not None:
+        if sys.version_info >= (3, 12):
+            # 3.12+ では uvloop.install() は非推奨（警告が出る）→ loop_factory で渡す
+            run_kwargs["loop_factory"] = uvloop.new_event_loop
+        else:
+            uvloop.install()
+    try:
+        asyncio.run(main(), **run_kwargs)
+    finally:
+        listener.stop()
@@ -0,0 +1,19 @@
+# utils/guilds.py
+# ギルド関連の小物（session_channels / ho_select 共用）
+# ✅ Bot は起動時にメンバーを chunk しない（main.py: chunk_guilds_at_startup=False）
+# ✅ guild.get_member で一覧を引く処理の前に ensure_chunked() を呼び、必要なギルドだけ遅延で取得する
+
+import discord
+
+
+async def ensure_chunked(guild: discord.Guild):
+    """
+    ギルドのメンバーをキャッシュに揃える（初回だけ / 2回目以降は何もしない）。
+    members intent が OFF なら取得できないので、そのまま（キャッシュにいる分だけで動く）。
+    """
+    if guild.chunked:
+        return
+    try:
+        await guild.chunk(cache=True)
+    except discord.ClientException:
+        pass
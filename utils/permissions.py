@@ -0,0 +1,16 @@
+# utils/permissions.py
+# チャンネル権限（PermissionOverwrite）の定数（session_channels / ho_select 共用）
+# ✅ 権限は値として使うだけ（書き換えない）ので、毎回作らずにこのオブジェクトを共有する
+# ✅ overwrites dict に入れた後も in-place で変更しないこと（全チャンネルに波及する）
+
+import discord
+
+
+DENY_OW = discord.PermissionOverwrite(view_channel=False)
+PARTICIPANT_OW = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
+READONLY_OW = discord.PermissionOverwrite(view_channel=True, send_messages=False, read_message_history=True)
+
+
+def member_ow(archived: bool) -> discord.PermissionOverwrite:
+    """参加者の権限（アーカイブ済みなら閲覧のみ）"""
+    return READONLY_OW if archived else PARTICIPANT_OW
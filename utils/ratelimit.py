@@ -0,0 +1,50 @@
+# utils/ratelimit.py
+# Discord API 呼び出しのレート制御（session_channels / ho_select 共用）
+# ✅ チャンネル/カテゴリの「作成」はギルド単位で「5回 / 5秒」程度のバケットがある
+# ✅ 429 を受けてから discord.py に待たせるより、送る前にこちらで間隔を空ける
+# ✅ 既存チャンネルの編集/削除は ch ごとの別バケットなので、ここでは絞らない
+# ✅ バケットはギルドごとに1つ（2つのCogで同じものを使う）
+
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+CHANNEL_MGMT_RATE = 5      # CHANNEL_MGMT_PER 秒あたりの回数
+CHANNEL_MGMT_PER = 5.0     # 秒
+
+
+class TokenBucket:
+    """
+    rate 回 / per 秒のトークンバケット。
+    acquire() はトークンが溜まるまで待つ（待ちは到着順）。
+    """
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+_channel_buckets: Dict[int, TokenBucket] = defaultdict(lambda: TokenBucket(CHANNEL_MGMT_RATE, CHANNEL_MGMT_PER))
+
+
+def channel_bucket(guild_id: int) -> TokenBucket:
+    """ギルドのチャンネル/カテゴリ作成用バケット"""
+    return _channel_buckets[guild_id]
@@ -0,0 +1,183 @@
+# utils/sessions_db.py
+# セッションDB（session_channels / ho_select 共用）
+# ✅ SQLite（data/sessions.db）に1セッション=1行で保存（変更したセッションの行だけ書く）
+# ✅ 書き込みは asyncio.to_thread でイベントループの外へ（クリック中に Bot 全体が止まらない）
+# ✅ 2つのCogが同じDBを触るので、読み書きは1つのロックで直列化
+# ✅ 起動時に1回だけ読み込み、以降はメモリ上の dict を参照（クリック毎の読み直しなし）
+# ✅ 書き込みはデバウンス（FLUSH_INTERVAL 内の変更を1回のコミットにまとめる）
+# ✅ 旧 sessions.json があれば初回起動時に取り込む（取り込み後は sessions.json.migrated にリネーム）
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import orjson
+
+
+DATA_DIR = "data"
+DB_PATH = os.path.join(DATA_DIR, "sessions.db")
+LEGACY_JSON_PATH = os.path.join(DATA_DIR, "sessions.json")
+
+FLUSH_INTERVAL = 2.0  # 変更をまとめて書き込むまでの待ち時間（秒）
+
+# 標準 json と同様に int キーも文字列キーとして書く（orjson は既定だとエラー）
+_DUMP_OPTS = orjson.OPT_NON_STR_KEYS
+
+log = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+_db: Optional[dict] = None
+_dirty: Optional[asyncio.Event] = None
+_flusher: Optional[asyncio.Task] = None
+_flush_lock: Optional[asyncio.Lock] = None
+_changed: Set[str] = set()
+_deleted: Set[str] = set()
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        # flush はワーカースレッドから行うので check_same_thread=False（アクセスは _LOCK で直列化）
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _migrate_legacy_json(conn: sqlite3.Connection):
+    if not os.path.exists(LEGACY_JSON_PATH):
+        return
+    if conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+        return
+    with open(LEGACY_JSON_PATH, "rb") as f:
+        legacy = orjson.loads(f.read())
+    rows = [
+        (sid, orjson.dumps(s, option=_DUMP_OPTS).decode())
+        for sid, s in (legacy.get("sessions") or {}).items()
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO sessions (id, data) VALUES (?, ?)", rows)
+    # 二重取り込み防止（元ファイルは残す）
+    os.replace(LEGACY_JSON_PATH, LEGACY_JSON_PATH + ".migrated")
+
+
+def load_db() -> dict:
+    with _LOCK:
+        conn = _connect()
+        _migrate_legacy_json(conn)
+        sessions = {sid: orjson.loads(data) for sid, data in conn.execute("SELECT id, data FROM sessions")}
+    return {"sessions": sessions}
+
+
+def _write_rows(rows: List[Tuple[str, str]], deleted: List[str]):
+    with _LOCK:
+        conn = _connect()
+        with conn:
+            if rows:
+                conn.executemany("INSERT OR REPLACE INTO sessions (id, data) VALUES (?, ?)", rows)
+            if deleted:
+                conn.executemany("DELETE FROM sessions WHERE id = ?", [(sid,) for sid in deleted])
+
+
+def get_db() -> dict:
+    """
+    メモリ上の DB（初回だけ SQLite から読む）。
+    session_channels / ho_select は同じ dict を共有し、これを正として扱う。
+    """
+    global _db
+    if _db is None:
+        _db = load_db()
+    return _db
+
+
+async def aload_db() -> dict:
+    """get_db() の非同期版（初回の読み込みをイベントループ外で行う）"""
+    global _db
+    if _db is None:
+        db = await asyncio.to_thread(load_db)
+        if _db is None:
+            _db = db
+    return _db
+
+
+def mark_dirty():
+    """
+    変更ありとして書き込みを予約する。
+    FLUSH_INTERVAL 内の変更はまとめて1回のコミットになる。
+    """
+    global _dirty, _flusher
+    if _dirty is None:
+        _dirty = asyncio.Event()
+    _dirty.set()
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.create_task(_flush_loop())
+
+
+async def _flush_loop():
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            # 未書き込み分は flush() が戻しているので、次の周回で再試行
+            log.exception("sessions flush failed, will retry")
+
+
+async def flush():
+    """未保存の変更があれば今すぐ書き込む（Cog unload 時など）"""
+    global _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+    # 古いスナップショットが新しいものを上書きしないよう、flush 同士は順番に
+    async with _flush_lock:
+        if _dirty is None or not _dirty.is_set():
+            return
+        _dirty.clear()
+
+        # 直列化はループ側で行い、その時点のスナップショットを書く
+        sessions: Dict[str, dict] = get_db()["sessions"]
+        rows = [
+            (sid, orjson.dumps(sessions[sid], option=_DUMP_OPTS).decode())
+            for sid in _changed
+            if sid in sessions
+        ]
+        deleted = list(_deleted)
+        _changed.clear()
+        _deleted.clear()
+
+        try:
+            await asyncio.to_thread(_write_rows, rows, deleted)
+        except Exception:
+            # 書けなかった分を戻す（待っている間に別の変更で印が付いた id はそちらを優先）
+            for sid, _ in rows:
+                if sid not in _deleted:
+                    _changed.add(sid)
+            for sid in deleted:
+                if sid not in _changed:
+                    _deleted.add(sid)
+            _dirty.set()
+            raise
+
+
+async def save_session(session: dict):
+    sid = session["id"]
+    get_db()["sessions"][sid] = session
+    _deleted.discard(sid)
+    _changed.add(sid)
+    mark_dirty()
+
+
+async def delete_session(session_id: str):
+    if get_db()["sessions"].pop(session_id, None) is not None:
+        _changed.discard(session_id)
+        _deleted.add(session_id)
+        mark_dirty()